@@ -1,38 +1,76 @@
 import os
+import pickle
 import yaml
-from datetime import datetime
+from datetime import date, datetime
 from typing import Dict, Any
 
+# 优先使用libyaml的C实现，解析/序列化比纯Python快数倍
+try:
+    from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
+
 class Config:
     _instance = None
-    _config = None
 
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super(Config, cls).__new__(cls)
+            instance = super(Config, cls).__new__(cls)
+            instance._config = None
+            instance._today = None
+            instance.load_config()
+            cls._instance = instance
         return cls._instance
 
-    def __init__(self):
-        if self._config is None:
-            self.load_config()
-
     def load_config(self):
         """加载配置文件"""
         config_path = os.path.join(os.path.dirname(__file__), 'config.yaml')
-        
+
         # 如果配置文件不存在，创建默认配置
         if not os.path.exists(config_path):
             self.create_default_config()
-        
-        # 读取配置文件
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self._config = yaml.safe_load(f)
-        
+
+        # 热启动时优先读pickle旁路缓存（带mtime保护），跳过YAML解析
+        cache_path = config_path + '.pkl'
+        self._config = None
+        try:
+            if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(config_path):
+                with open(cache_path, 'rb') as f:
+                    self._config = pickle.load(f)
+        except Exception:
+            self._config = None
+
+        if self._config is None:
+            # 读取配置文件
+            with open(config_path, 'r', encoding='utf-8') as f:
+                self._config = yaml.load(f, Loader=_YamlLoader)
+
+            # 缓存原始解析结果，'now'等占位符原样保留
+            try:
+                with open(cache_path, 'wb') as f:
+                    pickle.dump(self._config, f, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                pass
+
         # 创建必要的目录
         self.create_directories()
-        
-        # 处理动态值
-        self.process_dynamic_values()
+
+        # 预先展平配置，get()只做一次字典查找
+        self._build_flat_config()
+
+    def _build_flat_config(self):
+        """把嵌套配置展平成'a.b.c'形式的字典"""
+        flat = {}
+
+        def walk(prefix, node):
+            for k, v in node.items():
+                key = f"{prefix}.{k}" if prefix else k
+                flat[key] = v
+                if isinstance(v, dict):
+                    walk(key, v)
+
+        walk('', self._config)
+        self._flat_config = flat
 
     def create_default_config(self):
         """创建默认配置文件"""
@@ -60,6 +98,8 @@ class Config:
                 'akshare_timeout': 45,
                 'batch_size': {
                     'us': 100,
+                    # Tushare daily单次调用行数上限约6000：5只×约1200个
+                    # 交易日刚好贴着上限，再大会被静默截断产生残缺历史
                     'cn': 5
                 },
                 'analysis_batch': {
@@ -96,7 +136,7 @@ class Config:
         
         config_path = os.path.join(os.path.dirname(__file__), 'config.yaml')
         with open(config_path, 'w', encoding='utf-8') as f:
-            yaml.dump(default_config, f, default_flow_style=False, allow_unicode=True)
+            yaml.dump(default_config, f, Dumper=_YamlDumper, default_flow_style=False, allow_unicode=True)
 
     def create_directories(self):
         """创建必要的目录"""
@@ -106,24 +146,11 @@ class Config:
         ]
         
         for directory in directories:
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-
-    def process_dynamic_values(self):
-        """处理配置中的动态值"""
-        # 处理日期
-        if self._config['download']['date_range']['end_date'] == 'now':
-            self._config['download']['date_range']['end_date'] = datetime.now().strftime('%Y-%m-%d')
+            os.makedirs(directory, exist_ok=True)
 
     def get(self, key: str, default: Any = None) -> Any:
         """获取配置值"""
-        try:
-            value = self._config
-            for k in key.split('.'):
-                value = value[k]
-            return value
-        except (KeyError, TypeError):
-            return default
+        return self._flat_config.get(key, default)
 
     @property
     def db_url(self) -> str:
@@ -158,8 +185,15 @@ class Config:
 
     @property
     def date_range(self) -> Dict[str, str]:
-        """获取日期范围"""
-        return self._config['download']['date_range']
+        """获取日期范围（end_date='now'在读取时按天惰性解析）"""
+        date_range = dict(self._config['download']['date_range'])
+        if date_range['end_date'] == 'now':
+            today = date.today()
+            if self._today != today:
+                self._today = today
+                self._today_str = today.strftime('%Y-%m-%d')
+            date_range['end_date'] = self._today_str
+        return date_range
     
     @property
     def analysis_batch_config(self) -> Dict[str, Any]:
@@ -1,24 +1,45 @@
+import csv
+import io
+import logging
 import os
+import pickle
 import yfinance as yf
 import akshare as ak
+import numpy as np
 import pandas as pd
 import time
 import asyncio
 import aiohttp
+import weakref
 import nest_asyncio
 from sqlalchemy import create_engine, text
 from datetime import datetime, timedelta
+from functools import lru_cache, partial
 from dotenv import load_dotenv
 from tqdm import tqdm
 import requests
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
 import sys
 import tushare as ts
-from utils.download_util import DownloadStats
+from utils.download_util import AsyncRateLimiter, CircuitBreaker, DownloadStats
+from utils.ma_kernels import HAS_NUMBA, rolling_means
+
+# bottleneck可选：提供C实现的move_mean，没有时退回numpy cumsum
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
+
+# uvloop可选：libuv实现的事件循环，调度/IO开销远低于纯Python默认循环
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Enable nested asyncio for Jupyter compatibility
-nest_asyncio.apply()
+# 只在notebook内核里打补丁：CLI路径下它给每次任务调度加一层Python包装
+if 'ipykernel' in sys.modules:
+    nest_asyncio.apply()
 
 # Load environment variables
 load_dotenv()
@@ -26,6 +47,14 @@ load_dotenv()
 # 导入配置
 from config import config
 
+# 每符号级别的细节日志走DEBUG：打印带GIL获取和flush开销，
+# 几千个符号的热路径里积累成秒级；默认级别下这些调用几乎零成本
+logging.basicConfig(
+    level=getattr(logging, str(config.get('logging.level', 'INFO')).upper(), logging.INFO),
+    format=config.get('logging.format', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
+logger = logging.getLogger(__name__)
+
 # 设置Tushare token
 ts.set_token(config.tushare_token)
 
@@ -37,15 +66,65 @@ RETRY_DELAY = config.retry_config['base_delay']
 BATCH_SIZE = config.batch_sizes['us']
 BATCH_SIZE_CN = config.batch_sizes['cn']
 START_DATE = config.date_range['start_date']
+# 预解析起始日期：strptime每次要几微秒，没必要每批重复解析
+_START_DATE = datetime.strptime(START_DATE, '%Y-%m-%d').date()
+_START_DATE_YYYYMMDD = _START_DATE.strftime('%Y%m%d')
+# yfinance内部用pd.Timestamp，直接给Timestamp省掉它的再解析
+_START_DATE_YF = pd.Timestamp(START_DATE)
 
 backfill = len(sys.argv) > 1 and sys.argv[1] == '--backfill'
 force_download = len(sys.argv) > 1 and sys.argv[1] == '--download'
 china_stock = len(sys.argv) > 1 and sys.argv[1] == '--china'
+all_markets = len(sys.argv) > 1 and sys.argv[1] == '--all'
+
+# 令牌桶限速：令牌平滑补充，请求按实际配额尽快放行，
+# 替代原来只建不用的Semaphore+整秒sleep组合
+yahoo_limiter = AsyncRateLimiter(YAHOO_CALLS_PER_SECOND)
+akshare_limiter = AsyncRateLimiter(AKSHARE_CALLS_PER_SECOND)
+
+# 每个数据源一个熔断器：源挂掉时快速失败，不为每只股票跑完整退避链
+yahoo_breaker = CircuitBreaker(failure_threshold=20, recovery_timeout=60, name='yahoo')
+tushare_breaker = CircuitBreaker(failure_threshold=20, recovery_timeout=60, name='tushare')
+
+# 速率和并发是两回事：令牌桶管每秒放行次数，这个信号量管
+# 同时在途的yf.download数量，避免把速率配额误当并发上限。
+# 按事件循环各建一个实例：task_manager每次下载都新建loop，
+# asyncio原语会绑定首个产生waiter的loop，跨loop复用抛RuntimeError
+YAHOO_CONCURRENCY = 4
+_yahoo_concurrency_by_loop = weakref.WeakKeyDictionary()
+
+def yahoo_concurrency():
+    """获取当前事件循环对应的美股下载并发信号量"""
+    loop = asyncio.get_running_loop()
+    sem = _yahoo_concurrency_by_loop.get(loop)
+    if sem is None:
+        sem = asyncio.Semaphore(YAHOO_CONCURRENCY)
+        _yahoo_concurrency_by_loop[loop] = sem
+    return sem
 
-# Semaphores for rate limiting
-yahoo_semaphore = asyncio.Semaphore(YAHOO_CALLS_PER_SECOND)
-akshare_semaphore = asyncio.Semaphore(AKSHARE_CALLS_PER_SECOND)
+# 共享下载线程池：进程内复用，避免每次调用重建/销毁OS线程
+_DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=config.rate_limits.get('pool', 16))
 
+# Tushare客户端惰性构建、进程内缓存：pro_api()在没配token时会直接
+# 抛异常，放在import期会连带拖垮web服务启动和只跑美股的路径
+@lru_cache(maxsize=None)
+def get_ts_pro():
+    """获取（首次调用时构建并缓存）tushare pro客户端"""
+    return ts.pro_api()
+
+# 共享HTTP会话：akshare/tushare内部走模块级requests.get/post，
+# 每个请求都重新做TCP+TLS握手；重定向到带连接池的会话后，
+# 几千次逐股请求复用keep-alive连接
+_HTTP_SESSION = requests.Session()
+_http_adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32)
+_HTTP_SESSION.mount('https://', _http_adapter)
+_HTTP_SESSION.mount('http://', _http_adapter)
+requests.get = _HTTP_SESSION.get
+requests.post = _HTTP_SESSION.post
+
+# 模块级汇总统计：每次main_async重建，结束后由task_manager读取。
+# 各市场的计数在download_stocks_async里独立累计后再merge进来，
+# --all模式下两个市场并发跑也不会互相覆盖total
 stats = DownloadStats()
 
 async def retry_with_backoff(func, *args, **kwargs):
@@ -64,17 +143,126 @@ async def retry_with_backoff(func, *args, **kwargs):
             print(f"Attempt {attempt + 1} failed with error: {str(e)}. Retrying in {delay} seconds...")
             await asyncio.sleep(delay)
 
+@lru_cache(maxsize=128)
+def cached_text(sql):
+    """缓存text()语句对象，避免每次调用重新解析绑定参数"""
+    return text(sql)
+
+@lru_cache(maxsize=None)
+def price_upsert_stmt(table_name):
+    """按表名缓存价格表upsert语句，避免每批重新拼接/解析SQL"""
+    return text(f"""
+        INSERT INTO {table_name} (
+            symbol, date, open, high, low, close, volume,
+            ma5, ma10, ma20, ma60, ma200
+        )
+        VALUES (
+            :symbol, :date, :open, :high, :low, :close, :volume,
+            :ma5, :ma10, :ma20, :ma60, :ma200
+        )
+        ON CONFLICT (symbol, date) DO UPDATE SET
+            open = EXCLUDED.open,
+            high = EXCLUDED.high,
+            low = EXCLUDED.low,
+            close = EXCLUDED.close,
+            volume = EXCLUDED.volume,
+            ma5 = EXCLUDED.ma5,
+            ma10 = EXCLUDED.ma10,
+            ma20 = EXCLUDED.ma20,
+            ma60 = EXCLUDED.ma60,
+            ma200 = EXCLUDED.ma200
+    """)
+
+@lru_cache(maxsize=None)
+def info_upsert_stmt(table_name):
+    """按表名缓存股票信息upsert语句"""
+    return text(f"""
+        INSERT INTO {table_name} (symbol, name, exchange, market, update_time)
+        VALUES (:symbol, :name, :exchange, :market, :update_time)
+        ON CONFLICT (symbol) DO UPDATE SET
+            name = EXCLUDED.name,
+            exchange = EXCLUDED.exchange,
+            market = EXCLUDED.market,
+            update_time = EXCLUDED.update_time
+    """)
+
+# 超过该行数时改用COPY+临时表合并，避免executemany的逐行开销
+BULK_COPY_MIN_ROWS = 1000
+
+def bulk_upsert_prices(table_name, params):
+    """大批量价格upsert：COPY进临时表后用一条INSERT ... ON CONFLICT合并"""
+    columns = ['symbol', 'date', 'open', 'high', 'low', 'close', 'volume',
+               'ma5', 'ma10', 'ma20', 'ma60', 'ma200']
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for p in params:
+        writer.writerow(['' if p[c] is None else p[c] for c in columns])
+    buf.seek(0)
+
+    engine = get_db_engine()
+    raw_conn = engine.raw_connection()
+    column_list = ', '.join(columns)
+    try:
+        cursor = raw_conn.cursor()
+        cursor.execute(f"CREATE TEMP TABLE stg_prices (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP")
+        # 显式列清单：COPY和合并不再依赖表的物理列顺序
+        cursor.copy_expert(f"COPY stg_prices ({column_list}) FROM STDIN WITH CSV", buf)
+        cursor.execute(f"""
+            INSERT INTO {table_name} ({column_list})
+            SELECT {column_list} FROM stg_prices
+            ON CONFLICT (symbol, date) DO UPDATE SET
+                open = EXCLUDED.open,
+                high = EXCLUDED.high,
+                low = EXCLUDED.low,
+                close = EXCLUDED.close,
+                volume = EXCLUDED.volume,
+                ma5 = EXCLUDED.ma5,
+                ma10 = EXCLUDED.ma10,
+                ma20 = EXCLUDED.ma20,
+                ma60 = EXCLUDED.ma60,
+                ma200 = EXCLUDED.ma200
+        """)
+        raw_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+_db_engine = None
+
 def get_db_engine():
-    """Create SQLAlchemy engine for PostgreSQL"""
-    return create_engine(config.db_url)
+    """Create SQLAlchemy engine for PostgreSQL (cached, one pool per process)"""
+    global _db_engine
+    if _db_engine is None:
+        # 默认池只有5+10个连接，并发批次会在checkout上排队；
+        # pre_ping/recycle防止长跑任务拿到被服务端断掉的连接
+        _db_engine = create_engine(
+            config.db_url,
+            pool_size=32,
+            max_overflow=16,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            query_cache_size=1200,
+            # text()写的upsert不走values_only的execute_values快路径，
+            # 没有这项psycopg2会退回逐行round-trip；小批量（低于
+            # BULK_COPY_MIN_ROWS走executemany的那些）正是增量模式的常态
+            executemany_mode='values_plus_batch',
+            executemany_batch_page_size=500,
+        )
+    return _db_engine
 
-def initialize_database():
-    """Create tables if they don't exist"""
+def execute_ddl(statements):
+    """在单个事务中执行一组DDL，保证一次提交且模式初始化原子化"""
     engine = get_db_engine()
-    
     with engine.begin() as conn:
-        # Create task status table
-        conn.execute(text("""
+        for statement in statements:
+            conn.execute(text(statement))
+
+def initialize_database():
+    """Create tables if they don't exist"""
+    statements = [
+        """
             CREATE TABLE IF NOT EXISTS task_status (
                 id SERIAL PRIMARY KEY,
                 task_type VARCHAR(50),
@@ -88,54 +276,25 @@ def initialize_database():
                 failed_symbols INT,
                 error_message TEXT
             )
-        """))
-        print("Created task_status table")
-        
-        # Create stock info tables
-        conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS us_stocks_info (
-                symbol VARCHAR(20) PRIMARY KEY,
-                name VARCHAR(100),
-                exchange VARCHAR(20),
-                market VARCHAR(10),
-                update_time TIMESTAMP
-            )
-        """))
-        print("Created us_stocks_info table")
-        
-        conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS cn_stocks_info (
+        """,
+        # 运行中任务的部分索引很小，使轮询的EXISTS检查走index-only查找
+        "CREATE INDEX IF NOT EXISTS idx_task_status_running ON task_status(market) WHERE status = 'running'",
+        # 最新任务查询按(task_type, market)过滤再按start_time倒序取1行
+        "CREATE INDEX IF NOT EXISTS idx_task_status_latest ON task_status(task_type, market, start_time DESC)",
+    ]
+
+    for market in ('us', 'cn'):
+        statements.append(f"""
+            CREATE TABLE IF NOT EXISTS {market}_stocks_info (
                 symbol VARCHAR(20) PRIMARY KEY,
                 name VARCHAR(100),
                 exchange VARCHAR(20),
                 market VARCHAR(10),
                 update_time TIMESTAMP
             )
-        """))
-        print("Created cn_stocks_info table")
-        
-        # Create price tables
-        conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS us_stock_prices (
-                symbol VARCHAR(20),
-                date DATE,
-                open NUMERIC(10,2),
-                high NUMERIC(10,2),
-                low NUMERIC(10,2),
-                close NUMERIC(10,2),
-                volume BIGINT,
-                ma5 NUMERIC(10,2),
-                ma10 NUMERIC(10,2),
-                ma20 NUMERIC(10,2),
-                ma60 NUMERIC(10,2),
-                ma200 NUMERIC(10,2),
-                PRIMARY KEY (symbol, date)
-            )
-        """))
-        print("Created us_stock_prices table")
-        
-        conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS cn_stock_prices (
+        """)
+        statements.append(f"""
+            CREATE TABLE IF NOT EXISTS {market}_stock_prices (
                 symbol VARCHAR(20),
                 date DATE,
                 open NUMERIC(10,2),
@@ -150,21 +309,50 @@ def initialize_database():
                 ma200 NUMERIC(10,2),
                 PRIMARY KEY (symbol, date)
             )
-        """))
-        print("Created cn_stock_prices table")
-        
+        """)
         # Create indexes for better query performance
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_us_stock_prices_symbol ON us_stock_prices(symbol)"))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_us_stock_prices_date ON us_stock_prices(date)"))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_cn_stock_prices_symbol ON cn_stock_prices(symbol)"))
-        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_cn_stock_prices_date ON cn_stock_prices(date)"))
+        statements.append(f"DROP INDEX IF EXISTS idx_{market}_stock_prices_date")
+        statements.extend(price_index_statements(market))
+
+    execute_ddl(statements)
+    print("Created database tables and indexes")
+
+def price_index_statements(market):
+    """价格表非主键索引的建表语句（初始化和回填后重建共用）"""
+    return [
+        f"CREATE INDEX IF NOT EXISTS idx_{market}_stock_prices_symbol ON {market}_stock_prices(symbol)",
+        # date是近似追加写入的时间序列列，BRIN比btree小几个数量级，
+        # 且对date >= :start_date这类范围扫描更友好
+        f"CREATE INDEX IF NOT EXISTS idx_{market}_stock_prices_date_brin ON {market}_stock_prices USING BRIN (date) WITH (pages_per_range = 32)",
+    ]
+
+def drop_price_indexes(market):
+    """回填前删掉非主键索引：全量写入时省去每行的索引维护"""
+    execute_ddl([
+        f"DROP INDEX IF EXISTS idx_{market}_stock_prices_symbol",
+        f"DROP INDEX IF EXISTS idx_{market}_stock_prices_date_brin",
+    ])
+
+def recreate_price_indexes(market):
+    """回填完成后一次性重建索引，比逐行维护快得多"""
+    execute_ddl(price_index_statements(market))
+
+def get_last_dates(table_name, symbols):
+    """查询每只股票已入库的最新日期，用于增量下载"""
+    engine = get_db_engine()
+    with engine.connect() as conn:
+        result = conn.execute(
+            cached_text(f"SELECT symbol, MAX(date) AS last_date FROM {table_name}"
+                        " WHERE symbol = ANY(:syms) GROUP BY symbol"),
+            {'syms': list(symbols)})
+        return {row.symbol: row.last_date for row in result}
 
 def get_stored_symbols_count(market='CN'):
     """获取数据库中存储的股票数量"""
     engine = get_db_engine()
     table_name = f"{market.lower()}_stocks_info"
     with engine.connect() as conn:
-        result = conn.execute(text(f"SELECT COUNT(*) FROM {table_name}"))
+        result = conn.execute(cached_text(f"SELECT COUNT(*) FROM {table_name}"))
         return result.scalar()
 
 def update_stock_info(symbols, market='cn'):
@@ -172,53 +360,114 @@ def update_stock_info(symbols, market='cn'):
     engine = get_db_engine()
     table_name = f"{market.lower()}_stocks_info"
     
+    if not symbols:
+        return
+
+    # 一次性构建所有参数，单条多行INSERT写入，避免每只股票一次round-trip
+    now = datetime.now()
+    params = [{
+        'symbol': symbol_info['symbol'],
+        'name': symbol_info.get('name', symbol_info['symbol']),
+        'exchange': symbol_info['exchange'],
+        'market': market.upper(),
+        'update_time': now
+    } for symbol_info in symbols]
+
     with engine.begin() as conn:
-        for symbol_info in symbols:
-            conn.execute(
-                text(f"""
-                    INSERT INTO {table_name} (symbol, name, exchange, market, update_time)
-                    VALUES (:symbol, :name, :exchange, :market, :update_time)
-                    ON CONFLICT (symbol) DO UPDATE SET
-                        name = EXCLUDED.name,
-                        exchange = EXCLUDED.exchange,
-                        market = EXCLUDED.market,
-                        update_time = EXCLUDED.update_time
-                """),
-                {
-                    'symbol': symbol_info['symbol'],
-                    'name': symbol_info.get('name', symbol_info['symbol']),
-                    'exchange': symbol_info['exchange'],
-                    'market': market.upper(),
-                    'update_time': datetime.now()
-                }
-            )
+        conn.execute(info_upsert_stmt(table_name), params)
+
+# 已完成股票文件的解析缓存（按文件），mtime未变化时直接复用，避免每次调用重读文件
+_finished_symbols_cache = {}
+
+# 已完成记录的有效期：这是崩溃后短时间内重跑的断点续传检查点，
+# 不是永久跳过名单。有效期必须短于task_manager的12小时调度间隔，
+# 否则定时增量刷新会把全部股票当作已完成而跳过
+FINISHED_SYMBOLS_TTL = 6 * 3600
+
+_FINISHED_TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _finished_symbols_path(market):
+    return os.path.join('stock_lists', f'successful_symbols_{market.lower()}.txt')
+
+def _finished_symbols_entries(market):
+    """读取已完成文件的(代码, 完成时间)列表（带mtime缓存）"""
+    filename = _finished_symbols_path(market)
+    if not os.path.exists(filename):
+        return []
+
+    mtime = os.path.getmtime(filename)
+    entry = _finished_symbols_cache.get(filename)
+    if entry is None or entry['mtime'] != mtime:
+        # 整个文件一次读入再splitlines，比逐行迭代少一层Python循环开销
+        with open(filename, 'rb') as f:
+            data = f.read()
+        entries = []
+        for line in data.splitlines():
+            if not line:
+                continue
+            parts = line.split(b'|', 1)
+            try:
+                finished_at = datetime.strptime(parts[1].decode(), _FINISHED_TS_FORMAT)
+            except (IndexError, ValueError):
+                continue  # 无时间戳的旧记录按已过期处理
+            entries.append((parts[0].decode(), finished_at))
+        entry = {'mtime': mtime, 'entries': entries}
+        _finished_symbols_cache[filename] = entry
+    return entry['entries']
+
+def get_finished_symbols(market='cn'):
+    """读取仍在有效期内的已完成股票代码集合"""
+    cutoff = datetime.now() - timedelta(seconds=FINISHED_SYMBOLS_TTL)
+    return frozenset(
+        symbol for symbol, finished_at in _finished_symbols_entries(market)
+        if finished_at >= cutoff)
+
+def save_finished_symbols(symbols, market='cn'):
+    """批量记录已完成的股票代码：每批整写一次文件
+
+    逐符号append会导致每只股票一次open+fsync；这里整批重写，
+    顺带丢掉过期行，文件不会随反复运行无限增长。
+    """
+    now = datetime.now()
+    cutoff = now - timedelta(seconds=FINISHED_SYMBOLS_TTL)
+    kept = [(symbol, finished_at)
+            for symbol, finished_at in _finished_symbols_entries(market)
+            if finished_at >= cutoff]
+    kept_symbols = {symbol for symbol, _ in kept}
+    new_symbols = [s for s in symbols if s not in kept_symbols]
+    if not new_symbols:
+        return
+    os.makedirs('stock_lists', exist_ok=True)
+    timestamp = now.strftime(_FINISHED_TS_FORMAT)
+    with open(_finished_symbols_path(market), 'w') as f:
+        f.writelines(
+            f"{symbol}|{finished_at.strftime(_FINISHED_TS_FORMAT)}\n"
+            for symbol, finished_at in kept)
+        f.writelines(f"{s}|{timestamp}\n" for s in new_symbols)
 
 def get_symbols_from_db(market='cn'):
     """从数据库获取股票信息"""
     engine = get_db_engine()
     table_name = f"{market.lower()}_stocks_info"
-    
-    filename = os.path.join('stock_lists', f'successful_symbols_cn.txt')
-    finished_symbols = []
-    if not os.path.exists(filename):
-        print(f"File not found: {filename}")
-    else:        
-        with open(filename, 'r') as f:
-            for line in f:
-                parts = line.strip().split('|')
-                finished_symbols.append(parts[0])
+
+    finished_symbols = get_finished_symbols(market)
     print("finished_symbols count: ", len(finished_symbols))
+
+    # 在SQL中过滤已完成的股票，只取用到的4列，减少传输和行构造开销
+    query = f"SELECT symbol, name, exchange, market FROM {table_name}"
+    params = {}
+    if finished_symbols:
+        query += " WHERE NOT (symbol = ANY(:finished))"
+        params['finished'] = list(finished_symbols)
+
     with engine.connect() as conn:
-        result = conn.execute(text(f"SELECT * FROM {table_name}"))
-        symbols = []
-        for row in result:
-            if row.symbol not in finished_symbols:
-                symbols.append({
-                    'symbol': row.symbol,
-                    'name': row.name,
-                    'exchange': row.exchange,
-                    'market': row.market.upper()
-                })
+        result = conn.execute(cached_text(query), params)
+        symbols = [{
+            'symbol': row.symbol,
+            'name': row.name,
+            'exchange': row.exchange,
+            'market': row.market.upper()
+        } for row in result]
         print("symbols count: ", len(symbols))
         return symbols
 
@@ -226,15 +475,52 @@ def get_symbols_from_db(market='cn'):
 MAX_RETRY_COUNT = 3
 FALLBACK_THRESHOLD = 0.5  # 如果获取到的数据少于数据库中的50%，则使用数据库数据
 
-def get_all_us_symbols(use_db=True):
-    """获取所有美股股票代码，带重试和回退机制"""
+# 股票清单的磁盘缓存TTL：清单一天最多变一次，没必要每次启动都打外部接口
+SYMBOLS_CACHE_TTL = 86400
+
+def _symbols_cache_path(market):
+    return os.path.join('stock_lists', f'symbols_{market.lower()}.pkl')
+
+def load_cached_symbols(market):
+    """读取未过期的股票清单缓存，没有或已过期返回None"""
+    path = _symbols_cache_path(market)
+    try:
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < SYMBOLS_CACHE_TTL:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+    except Exception as e:
+        print(f"Error loading symbols cache {path}: {str(e)}")
+    return None
+
+def store_cached_symbols(market, symbols):
+    """把新抓到的股票清单写入磁盘缓存"""
+    path = _symbols_cache_path(market)
+    try:
+        os.makedirs('stock_lists', exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(symbols, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        print(f"Error writing symbols cache {path}: {str(e)}")
+
+async def get_all_us_symbols(use_db=True):
+    """获取所有美股股票代码，带重试和回退机制
+
+    异步版本：网络调用进线程池，退避用asyncio.sleep，
+    重试等待期间事件循环可以继续跑其他市场的下载。
+    """
+    cached = load_cached_symbols('us')
+    if cached:
+        print(f"Using cached US symbols ({len(cached)})")
+        return cached
+
+    loop = asyncio.get_running_loop()
     retry_count = 0
     stored_count = get_stored_symbols_count('US') if use_db else 0
-    
+
     while retry_count < MAX_RETRY_COUNT:
         try:
             symbols = []
-            us_stocks = ak.get_us_stock_name()
+            us_stocks = await loop.run_in_executor(_DOWNLOAD_POOL, ak.get_us_stock_name)
             # 处理股票代码，移除前缀（例如：'AAPL.US' -> 'AAPL'）
             symbols.extend([{
                 'symbol': symbol.split('.')[1].replace('_', '.') if '.' in symbol else symbol,
@@ -255,7 +541,8 @@ def get_all_us_symbols(use_db=True):
             else:
                 # 更新数据库
                 update_stock_info(symbols, 'us')
-            
+                store_cached_symbols('us', symbols)
+
             return symbols
             
         except Exception as e:
@@ -268,17 +555,26 @@ def get_all_us_symbols(use_db=True):
                 return get_symbols_from_db('us')
             delay = RETRY_DELAY * (2 ** retry_count)  # Exponential backoff
             print(f"Attempt {retry_count + 1} failed with error: {str(e)}. Retrying in {delay} seconds...")
-            time.sleep(delay)
+            await asyncio.sleep(delay)
 
     return get_symbols_from_db('us')
 
-def get_all_china_symbols(use_db=True):
-    """获取所有A股股票代码，带重试和回退机制"""
+async def get_all_china_symbols(use_db=True):
+    """获取所有A股股票代码，带重试和回退机制
+
+    异步版本：Tushare调用进线程池，退避用asyncio.sleep（同美股版）。
+    """
+    cached = load_cached_symbols('cn')
+    if cached:
+        print(f"Using cached CN symbols ({len(cached)})")
+        return cached
+
     import akshare.utils.func as ak_func
     timeout_sec = config.akshare_timeout
     orig_fetch = ak_func.fetch_paginated_data
     ak_func.fetch_paginated_data = lambda url, base_params, timeout=15: orig_fetch(url, base_params, timeout=timeout_sec)
 
+    loop = asyncio.get_running_loop()
     retry_count = 0
     stored_count = get_stored_symbols_count('CN') if use_db else 0
 
@@ -313,12 +609,18 @@ def get_all_china_symbols(use_db=True):
                 #     'exchange': 'BJ'
                 # } for _, row in bj_stocks.iterrows()])
 
-                ts_stocks = ts.pro_api().stock_basic(exchange='', list_status='L',fields='ts_code,symbol,name,area,industry,list_date')
-                symbols.extend([{
-                    'symbol': row['symbol'],
-                    'name': row['name'],
-                    'exchange': row['ts_code'].split('.')[1]
-                } for _, row in ts_stocks.iterrows()])
+                ts_stocks = await loop.run_in_executor(
+                    _DOWNLOAD_POOL,
+                    lambda: get_ts_pro().stock_basic(exchange='', list_status='L',fields='ts_code,symbol,name,area,industry,list_date'))
+                # 直接zip底层数组构建，避免iterrows逐行装箱Series
+                exchanges = ts_stocks['ts_code'].str.split('.').str[1]
+                symbols.extend({
+                    'symbol': code,
+                    'name': name,
+                    'exchange': exchange
+                } for code, name, exchange in zip(
+                    ts_stocks['symbol'].to_numpy(), ts_stocks['name'].to_numpy(),
+                    exchanges.to_numpy()))
                 
                 # 检查数据质量
                 if stored_count > 0 and len(symbols) < stored_count * FALLBACK_THRESHOLD:
@@ -333,6 +635,7 @@ def get_all_china_symbols(use_db=True):
                 else:
                     # 更新数据库
                     update_stock_info(symbols, 'cn')
+                    store_cached_symbols('cn', symbols)
 
                 return symbols
 
@@ -346,21 +649,55 @@ def get_all_china_symbols(use_db=True):
                     return get_symbols_from_db('cn')
                 delay = RETRY_DELAY * (2 ** retry_count)  # Exponential backoff
                 print(f"Attempt {retry_count + 1} failed with error: {str(e)}. Retrying in {delay} seconds...")
-                time.sleep(delay)
+                await asyncio.sleep(delay)
 
         return get_symbols_from_db('cn')
     finally:
         ak_func.fetch_paginated_data = orig_fetch
 
-async def get_us_stocks_history(symbols, start_date):
-    """Download historical data for multiple stocks in one request"""
-    with ThreadPoolExecutor() as pool:
-        loop = asyncio.get_event_loop()
+# 美股下载分片数：每批拆成若干并发的yf.download调用
+US_DOWNLOAD_SHARDS = 4
+
+# 同时在途的批次数上限：限流由令牌桶负责，这里只防止任务堆积
+BATCH_CONCURRENCY = 4
+
+# 价格表中需要round(2)并做NaN→None转换的数值列
+PRICE_NUMERIC_COLS = ['Open', 'High', 'Low', 'Close', 'ma5', 'ma10', 'ma20', 'ma60']
+
+# 增量下载的MA预热期（日历日）：保证新行的ma60有足够的历史可算
+MA_WARMUP_DAYS = 210
+
+def _us_shards(symbols):
+    """把一批美股代码切成US_DOWNLOAD_SHARDS个分片"""
+    shard_size = max(1, (len(symbols) + US_DOWNLOAD_SHARDS - 1) // US_DOWNLOAD_SHARDS)
+    return [symbols[i:i + shard_size] for i in range(0, len(symbols), shard_size)]
+
+def _split_us_frame(shard, frame):
+    """把yf.download返回的多ticker帧拆成 {symbol: DataFrame}"""
+    data = {}
+    if frame is None or frame.empty:
+        return data
+    if len(shard) == 1:
+        # 单代码时yf返回平铺列，没有ticker层
+        data[shard[0]] = frame
+    else:
+        tickers = set(frame.columns.get_level_values(0))
+        for symbol in shard:
+            if symbol in tickers:
+                data[symbol] = frame[symbol]
+    return data
+
+async def _download_us_shard(shard, start_date, loop):
+    """下载一个分片的历史数据"""
+    # 熔断打开时直接失败，不占限速令牌也不等待
+    if not yahoo_breaker.allow():
+        raise RuntimeError("Yahoo circuit breaker open, skipping download")
+    async with yahoo_concurrency(), yahoo_limiter:
         try:
-            data = await loop.run_in_executor(
-                pool,
+            frame = await loop.run_in_executor(
+                _DOWNLOAD_POOL,
                 lambda: yf.download(
-                    symbols,
+                    shard,
                     start=start_date,
                     group_by='ticker',
                     auto_adjust=True,
@@ -368,222 +705,340 @@ async def get_us_stocks_history(symbols, start_date):
                     progress=False  # Disable progress bar to avoid confusion
                 )
             )
-            return data
-        except Exception as e:
-            print(f"Error downloading data: {str(e)}")
-            return {}
+        except Exception:
+            yahoo_breaker.record_failure()
+            raise
+        yahoo_breaker.record_success()
+        return frame
 
 async def get_china_stocks_history(symbol_infos, start_date):
-    with ThreadPoolExecutor() as pool:
-        loop = asyncio.get_event_loop()
-        try:
-            ts_code = ','.join([symbol_info['symbol']+'.'+symbol_info['exchange'] for symbol_info in symbol_infos])
-            print(f"Downloading data for {ts_code}")
-            hist = await loop.run_in_executor(
-                pool,
-                # lambda: ts.pro_api().daily(ts_code=symbol+'.'+exchange, 
-                #         start_date=START_DATE, 
-                #         end_date=datetime.now().strftime("%Y%m%d"))
-                lambda: ts.pro_api().daily(ts_code=ts_code, 
-                        start_date=START_DATE, 
-                        end_date=datetime.now().strftime("%Y%m%d"))
-            )
-            # df = ts.pro_api().daily(ts_code='000001.SZ,600000.SH', start_date='20180701', end_date='20180718')
-
-            if not hist.empty:
-                # 转换列名以匹配英文格式
-                hist['ts_code'] = hist['ts_code'].str.split('.').str[0]
-                hist = hist.rename(columns={
-                    'ts_code': 'Symbol',
-                    'trade_date': 'Date',
-                    'open': 'Open',
-                    'high': 'High',
-                    'low': 'Low',
-                    'close': 'Close',
-                    'vol': 'Volume'
-                })
-            return hist
-        except Exception as e:
-            print(f"Error downloading cn data: {str(e)}")
-            return pd.DataFrame()
-            # hist['Date'] = pd.to_datetime(hist['Date'])
-            # hist.set_index('Date', inplace=True)
-            
-            # # 计算移动平均线
-            # hist = calculate_moving_averages(hist)
-            # hist.reset_index(inplace=True)
-                        
+    loop = asyncio.get_event_loop()
+    try:
+        ts_code = ','.join([symbol_info['symbol']+'.'+symbol_info['exchange'] for symbol_info in symbol_infos])
+        logger.debug("Downloading data for %s", ts_code)
+        start_str = start_date.strftime('%Y%m%d') if start_date else _START_DATE_YYYYMMDD
+        end_date = datetime.now().strftime("%Y%m%d")
+        # 熔断打开时直接失败，不占限速令牌也不等待
+        if not tushare_breaker.allow():
+            raise RuntimeError("Tushare circuit breaker open, skipping download")
+        async with akshare_limiter:
+            try:
+                hist = await loop.run_in_executor(
+                    _DOWNLOAD_POOL,
+                    # lambda: get_ts_pro().daily(ts_code=symbol+'.'+exchange,
+                    #         start_date=start_str,
+                    #         end_date=end_date)
+                    lambda: get_ts_pro().daily(ts_code=ts_code,
+                            start_date=start_str,
+                            end_date=end_date)
+                )
+            except Exception:
+                tushare_breaker.record_failure()
+                raise
+            tushare_breaker.record_success()
+        # df = _TS_PRO.daily(ts_code='000001.SZ,600000.SH', start_date='20180701', end_date='20180718')
 
+        if not hist.empty:
+            # 转换列名以匹配英文格式（inplace避免整帧复制）
+            hist['ts_code'] = hist['ts_code'].str.split('.').str[0]
+            hist.rename(columns={
+                'ts_code': 'Symbol',
+                'trade_date': 'Date',
+                'open': 'Open',
+                'high': 'High',
+                'low': 'Low',
+                'close': 'Close',
+                'vol': 'Volume'
+            }, inplace=True)
+            # 日期转换和排序整批做一次，省掉每符号的copy往返
+            hist['Date'] = pd.to_datetime(hist['Date'], format='%Y%m%d', cache=True)
+            hist.sort_values(['Symbol', 'Date'], inplace=True, ignore_index=True)
+        return hist
+    except Exception as e:
+        print(f"Error downloading cn data: {str(e)}")
+        return pd.DataFrame()
+        # hist['Date'] = pd.to_datetime(hist['Date'])
+        # hist.set_index('Date', inplace=True)
+
+        # # 计算移动平均线
+        # hist = calculate_moving_averages(hist)
+        # hist.reset_index(inplace=True)
+
+
+
+def move_mean_multi(values, windows, min_counts):
+    """多窗口滑动均值：所有窗口共享一次cumsum，返回(n, len(windows))矩阵
+
+    优先走bottleneck的C实现；纯numpy路径也只遍历values一遍，
+    各窗口从同一对累积和/计数数组上切片得出。
+    """
+    for window, min_count in zip(windows, min_counts):
+        if min_count > window:
+            raise ValueError(f"min_count {min_count} must not exceed window {window}")
+
+    n = values.shape[0]
+    out = np.empty((n, len(windows)))
+    if bn is not None:
+        for j, (window, min_count) in enumerate(zip(windows, min_counts)):
+            out[:, j] = bn.move_mean(values, window=window, min_count=min_count)
+        return out
+
+    nan_mask = np.isnan(values)
+    cum_sum = np.cumsum(np.where(nan_mask, 0.0, values))
+    cum_cnt = np.cumsum(~nan_mask)
+    for j, (window, min_count) in enumerate(zip(windows, min_counts)):
+        win_sum = cum_sum.copy()
+        win_cnt = cum_cnt.copy()
+        win_sum[window:] = cum_sum[window:] - cum_sum[:-window]
+        win_cnt[window:] = cum_cnt[window:] - cum_cnt[:-window]
+        col = np.full(n, np.nan)
+        valid = win_cnt >= min_count
+        col[valid] = win_sum[valid] / win_cnt[valid]
+        out[:, j] = col
+    return out
+
+def move_mean(values, window, min_count):
+    """单窗口滑动均值，复用move_mean_multi"""
+    return move_mean_multi(values, [window], [min_count])[:, 0]
+
+MA_WINDOWS = [5, 10, 20, 60]
 
 def calculate_moving_averages(df):
     """Calculate moving averages for a DataFrame using available data"""
-    # Sort DataFrame by date
-    df = df.sort_index()
-    
+    # Sort DataFrame by date（数据源基本按时间升序返回，已排序时跳过重排）
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+
     # Handle missing values
     if 'Close' not in df.columns:
         print(f"Warning: 'Close' column not found in DataFrame. Columns: {df.columns}")
         return df
-    
-    # Remove any NaN values before calculating MAs
-    close_series = df['Close'].copy()
-    if close_series.isna().any():
-        print(f"Warning: Found {close_series.isna().sum()} NaN values in Close prices")
-    
+
+    # 在numpy数组上单遍计算，绕开pandas rolling的逐窗口调度开销
+    close = df['Close'].to_numpy(dtype=np.float64, copy=False)
+    nan_count = int(np.isnan(close).sum())
+    if nan_count:
+        logger.debug("Found %d NaN values in Close prices", nan_count)
+
+    available_periods = close.shape[0]
     try:
-        # Calculate basic moving averages with minimum periods
-        ma_windows = [5, 10, 20, 60]
-        available_periods = len(close_series)
-        
         # Initialize all MA columns
-        for window in ma_windows:
+        for window in MA_WINDOWS:
             df[f'ma{window}'] = None
-        
+
         if available_periods > 0:
-            # Calculate MA for each window
-            for i, window in enumerate(ma_windows):
-                # If we don't have enough data for the full window,
-                # use the maximum available periods but at least 5 days
-                min_periods = min(max(5, available_periods), window)
-                ma = close_series.rolling(window=window, min_periods=min_periods).mean().round(2)
-                
-                # For shorter periods, use the shorter MA for longer windows
+            # If we don't have enough data for the full window,
+            # use the maximum available periods but at least 5 days
+            windows = [min(window, available_periods) for window in MA_WINDOWS]
+            min_counts = [min(max(5, available_periods), window) for window in MA_WINDOWS]
+            for window in MA_WINDOWS:
                 if available_periods < window:
-                    print(f"Only {available_periods} periods available, using MA{available_periods} for MA{window}")
-                    # Calculate MA with available periods
-                    shorter_ma = close_series.rolling(window=available_periods, min_periods=min_periods).mean().round(2)
-                    df[f'ma{window}'] = shorter_ma
-                else:
-                    df[f'ma{window}'] = ma
-                
+                    logger.debug("Only %d periods available, using MA%d for MA%d", available_periods, available_periods, window)
+
+            if HAS_NUMBA:
+                # numba可用时走JIT核心：单遍扫描同时算完所有窗口
+                out = rolling_means(close, windows, min_counts)
+            else:
+                out = move_mean_multi(close, windows, min_counts)
+
+            # 整个MA矩阵就地round一次：一次连续内存的ufunc调度，
+            # 代替每个窗口各来一遍
+            np.round(out, 2, out=out)
+            for j, window in enumerate(MA_WINDOWS):
+                df[f'ma{window}'] = out[:, j]
+
     except Exception as e:
         print(f"Error calculating moving averages: {str(e)}")
         # Initialize MA columns to avoid KeyError
-        for window in ma_windows:
+        for window in MA_WINDOWS:
             df[f'ma{window}'] = None
-    
+
     return df
 
 async def process_stocks_batch(symbol_infos, engine, market='us'):
     """Process a batch of US stocks asynchronously"""
     try:
         symbols = [info['symbol'] for info in symbol_infos]
-        default_start = datetime.strptime(START_DATE, '%Y-%m-%d').date()
-        start_date = default_start
+        start_date = _START_DATE
+        loop = asyncio.get_event_loop()
         successful_symbols = set()
         table_name = f"{market.lower()}_stock_prices"
+
+        # 增量加载：库里已有的符号只从(已存最新日期-MA预热期)起重拉，
+        # 稳定运行时每天的下载/写入量从全量历史降到新增交易日
+        last_dates = {}
+        if not backfill:
+            try:
+                last_dates = await loop.run_in_executor(
+                    _DOWNLOAD_POOL, get_last_dates, table_name, symbols)
+            except Exception as e:
+                print(f"Error fetching last dates, doing full download: {str(e)}")
+                last_dates = {}
+        if last_dates and len(last_dates) == len(symbols):
+            incremental_start = min(last_dates.values()) - timedelta(days=MA_WARMUP_DAYS)
+            if incremental_start > start_date:
+                start_date = incremental_start
+
         if start_date < datetime.now().date():
-            print(f"Downloading data for {len(symbols)} symbols: {symbols}")
+            logger.debug("Downloading data for %d symbols: %s", len(symbols), symbols)
+
+            # 先在内存里累积整批行，再一次性写库：BATCH_SIZE个符号的
+            # round-trip从每符号一次降到每批一次
+            batch_params = []
+            pending_symbols = []
+
+            async def process_symbol(symbol, symbol_data):
+                """单个符号：过滤→MA→积累行参数"""
+                try:
+                    if symbol_data.empty:
+                        logger.debug("Empty data for %s", symbol)
+                        return
+                    # 布尔切片本身返回持有自身数据的新帧，再copy()一次是纯浪费
+                    symbol_data = symbol_data[symbol_data['Close'].notna().to_numpy()]
+                    # Calculate moving averages before resetting index
+                    #symbol_data = calculate_moving_averages(symbol_data)
+
+                    # 计算移动平均线（丢到线程池算，不占事件循环线程；
+                    # numba核心nogil=True时多符号可真正并行）
+                    # CN批次在下载后已整批转换日期并排序，Date保持普通列，
+                    # 不再做每符号的set_index/reset_index往返
+                    symbol_data = await loop.run_in_executor(
+                        _DOWNLOAD_POOL, calculate_moving_averages, symbol_data)
+
+                    if market == 'us':
+                        symbol_data.reset_index(inplace=True)
+                    logger.debug("Downloaded %d records for %s", len(symbol_data), symbol)
+
+                    cutoff = last_dates.get(symbol)
+                    if cutoff is not None:
+                        # 预热区间只用来算MA，库里已有的行不再重复upsert
+                        symbol_data = symbol_data[symbol_data['Date'] > pd.Timestamp(cutoff)]
+                        if symbol_data.empty:
+                            successful_symbols.add(symbol)
+                            return
+
+                    # 向量化round/NaN→None转换，整列一次C层处理代替每行多次pd.notna
+                    clean = symbol_data[PRICE_NUMERIC_COLS].astype(float).round(2)
+                    clean = clean.astype(object).where(clean.notna(), None)
+                    volumes = symbol_data['Volume'].astype(object).where(symbol_data['Volume'].notna(), None)
+                    dates = symbol_data['Date'].dt.date
+                    batch_params.extend({
+                        'symbol': symbol,
+                        'date': d,
+                        'open': o,
+                        'high': h,
+                        'low': l,
+                        'close': c,
+                        'volume': int(v) if v is not None else None,
+                        'ma5': m5,
+                        'ma10': m10,
+                        'ma20': m20,
+                        'ma60': m60,
+                        'ma200': None
+                    } for d, o, h, l, c, v, m5, m10, m20, m60 in zip(
+                        dates.tolist(), clean['Open'].tolist(), clean['High'].tolist(),
+                        clean['Low'].tolist(), clean['Close'].tolist(), volumes.tolist(),
+                        clean['ma5'].tolist(), clean['ma10'].tolist(), clean['ma20'].tolist(),
+                        clean['ma60'].tolist()))
+                    pending_symbols.append(symbol)
+                except Exception as e:
+                    print(f"Error processing symbol {symbol}: {str(e)}")
+                    save_stock_to_file(symbol, market, 'failed', str(e))
+
             if market == 'us':
-                hist_data = await get_us_stocks_history(symbols, start_date)
+                # 分片按完成顺序消费：先落地的分片立刻做MA和行构建，
+                # 慢分片不再拖住其它99个符号的处理
+                shards = _us_shards(symbols)
+
+                yf_start = pd.Timestamp(start_date) if start_date != _START_DATE else _START_DATE_YF
+
+                async def shard_result(shard):
+                    return shard, await _download_us_shard(shard, yf_start, loop)
+
+                for future in asyncio.as_completed([shard_result(s) for s in shards]):
+                    shard, frame = await future
+                    shard_data = _split_us_frame(shard, frame)
+                    for symbol in shard:
+                        if symbol not in shard_data:
+                            logger.debug("No data available for %s", symbol)
+                            continue
+                        await process_symbol(symbol, shard_data[symbol])
             else:
                 hist_data = await get_china_stocks_history(symbol_infos, start_date)
-            # hist_data = await get_stocks_history(symbols, start_date)
-            
-            print(f"Successfully downloaded history data {len(hist_data)} ")
-
-            with engine.begin() as conn:
+                logger.debug("Successfully downloaded history data %d", len(hist_data))
+                # CN长表一次groupby切分，代替每符号一次O(N)布尔过滤
+                groups = {} if hist_data.empty else {
+                    sym: group for sym, group in hist_data.groupby('Symbol', sort=False)}
                 for symbol in symbols:
-                    try:
-                        if market == 'us':
-                            if symbol not in hist_data:
-                                print(f"No data available for {symbol}")
-                                continue
-                            
-                            symbol_data = hist_data[symbol]
-                        else:
-                            symbol_data = hist_data[hist_data['Symbol'] == symbol]
+                    if symbol not in groups:
+                        logger.debug("No data available for %s", symbol)
+                        continue
+                    await process_symbol(symbol, groups[symbol])
 
-                        if symbol_data.empty:
-                            print(f"Empty data for {symbol}")
-                            continue
-                        symbol_data = symbol_data[symbol_data['Close'].notna()].copy()  # Fix fragmentation warning
-                        # Calculate moving averages before resetting index
-                        #symbol_data = calculate_moving_averages(symbol_data)
-                        
-                        if market == 'cn':
-                            symbol_data['Date'] = pd.to_datetime(symbol_data['Date'])
-                            symbol_data.set_index('Date', inplace=True)
-                        
-                        # 计算移动平均线
-                        symbol_data = calculate_moving_averages(symbol_data)
+            # 整批一次写入：行数够多走COPY+临时表合并，否则单次executemany。
+            # psycopg2是同步驱动，写库放进线程池，COPY期间事件循环
+            # 可以继续驱动其它批次的下载
+            if batch_params:
+                def write_batch():
+                    if len(batch_params) >= BULK_COPY_MIN_ROWS:
+                        bulk_upsert_prices(table_name, batch_params)
+                    else:
+                        with engine.begin() as conn:
+                            conn.execute(price_upsert_stmt(table_name), batch_params)
 
-                        symbol_data.reset_index(inplace=True)
-                        print(f"Downloaded {len(symbol_data)} records for {symbol}")
-                        
-                        # Insert price data with moving averages
-                        for _, row in symbol_data.iterrows():
-                            conn.execute(text(f"""
-                                INSERT INTO {table_name} (
-                                    symbol, date, open, high, low, close, volume,
-                                    ma5, ma10, ma20, ma60, ma200
-                                )
-                                VALUES (
-                                    :symbol, :date, :open, :high, :low, :close, :volume,
-                                    :ma5, :ma10, :ma20, :ma60, :ma200
-                                )
-                                ON CONFLICT (symbol, date) DO UPDATE SET
-                                    open = EXCLUDED.open,
-                                    high = EXCLUDED.high,
-                                    low = EXCLUDED.low,
-                                    close = EXCLUDED.close,
-                                    volume = EXCLUDED.volume,
-                                    ma5 = EXCLUDED.ma5,
-                                    ma10 = EXCLUDED.ma10,
-                                    ma20 = EXCLUDED.ma20,
-                                    ma60 = EXCLUDED.ma60,
-                                    ma200 = EXCLUDED.ma200
-                            """), {
-                                'symbol': symbol,
-                                'date': row['Date'].date(),
-                                'open': round(float(row['Open']), 2) if pd.notna(row['Open']) else None,
-                                'high': round(float(row['High']), 2) if pd.notna(row['High']) else None,
-                                'low': round(float(row['Low']), 2) if pd.notna(row['Low']) else None,
-                                'close': round(float(row['Close']), 2) if pd.notna(row['Close']) else None,
-                                'volume': int(row['Volume']) if pd.notna(row['Volume']) else None,
-                                'ma5': round(float(row['ma5']), 2) if pd.notna(row['ma5']) else None,
-                                'ma10': round(float(row['ma10']), 2) if pd.notna(row['ma10']) else None,
-                                'ma20': round(float(row['ma20']), 2) if pd.notna(row['ma20']) else None,
-                                'ma60': round(float(row['ma60']), 2) if pd.notna(row['ma60']) else None,
-                                'ma200': None
-                            })
-                        successful_symbols.add(symbol)
-                    except Exception as e:
-                        print(f"Error processing symbol {symbol}: {str(e)}")
-                        save_stock_to_file(symbol, market, 'failed', str(e))
-                        continue
+                try:
+                    await loop.run_in_executor(_DOWNLOAD_POOL, write_batch)
+                    successful_symbols.update(pending_symbols)
+                except Exception as e:
+                    print(f"Error writing batch to {table_name}: {str(e)}")
+                    save_stocks_to_file(pending_symbols, market, 'failed', str(e))
+        # 整批只做一次已完成文件追加，而不是每只股票open+write
+        if successful_symbols:
+            save_finished_symbols(sorted(successful_symbols), market)
         return len(successful_symbols)
     except Exception as e:
         symbols_str = ', '.join(s['symbol'] for s in symbol_infos)
         print(f"Error processing {market.upper()} stocks batch {symbols_str}: {str(e)}")
-        for s in symbol_infos:
-            save_stock_to_file(s['symbol'], market, 'failed', str(e)) 
+        save_stocks_to_file([s['symbol'] for s in symbol_infos], market, 'failed', str(e))
         raise  # Re-raise the exception for the retry mechanism
 
+# 每个状态文件已写入的股票代码缓存：首次访问扫描一次文件，
+# 之后的去重检查只查内存集合，写入路径从O(N)降到O(1)
+_SEEN_CACHE = {}
+
+def _seen_symbols(filename):
+    """获取（按需加载）状态文件里已有的股票代码集合"""
+    seen = _SEEN_CACHE.get(filename)
+    if seen is None:
+        seen = set()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    parts = line.strip().split('|')
+                    if len(parts) >= 2:
+                        seen.add(parts[1])
+        _SEEN_CACHE[filename] = seen
+    return seen
+
 def save_stock_to_file(symbol, market='CN', status='failed', reason=''):
     """Save stock to file with status (failed/pending)"""
+    save_stocks_to_file([symbol], market, status, reason)
+
+def save_stocks_to_file(symbols, market='CN', status='failed', reason=''):
+    """批量写入状态文件：整批只打开一次文件"""
     status_dir = 'stock_lists'
     os.makedirs(status_dir, exist_ok=True)
-    
+
     filename = os.path.join(status_dir, f'{status}_{market.lower()}_stocks.txt')
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    # 确保文件存在
-    if not os.path.exists(filename):
-        open(filename, 'a').close()
-    
-    # 读取现有内容，避免重复
-    existing_symbols = set()
-    with open(filename, 'r') as f:
-        for line in f:
-            parts = line.strip().split('|')
-            if len(parts) >= 2:
-                existing_symbols.add(parts[1])
-    
+
     # 如果股票代码不存在，则添加
-    if symbol not in existing_symbols:
+    seen = _seen_symbols(filename)
+    new_symbols = [s for s in symbols if s not in seen]
+    if new_symbols:
         with open(filename, 'a') as f:
-            f.write(f"{timestamp}|{symbol}|{reason}\n")
+            f.writelines(f"{timestamp}|{s}|{reason}\n" for s in new_symbols)
+        seen.update(new_symbols)
 
 def get_all_stock_symbols_from_file(market, status='failed'):
     """从文件读取股票代码"""
@@ -595,71 +1050,111 @@ def get_all_stock_symbols_from_file(market, status='failed'):
         return symbols
         
     with open(filename, 'r') as f:
-        for line in f:
-            print(line)
-            parts = line.strip().split('|')
-            print(parts)
-            if len(parts) >= 2:
-                symbol = parts[1]
-                print(symbol)
-                if market == 'cn':
-                    symbols.append({
-                        'symbol': symbol,
-                        'name': symbol,  # 使用代码作为名称
-                        'exchange': 'Unknown'
-                    })
-                else:  # US
-                    symbols.append({
-                        'symbol': symbol,
-                        'exchange': 'Unknown'
-                    })
-    
+        parsed = [line.strip().split('|', 2) for line in f]
+
+    # 集合去重：历史文件可能跨多次运行追加过同一只股票
+    unique = list(dict.fromkeys(
+        parts[1] for parts in parsed if len(parts) >= 2))
+
+    if market == 'cn':
+        symbols = [{
+            'symbol': symbol,
+            'name': symbol,  # 使用代码作为名称
+            'exchange': 'Unknown'
+        } for symbol in unique]
+    else:  # US
+        symbols = [{
+            'symbol': symbol,
+            'exchange': 'Unknown'
+        } for symbol in unique]
+
     return symbols
 
 async def download_stocks_async(market='us'):
     if backfill:
         symbols = get_all_stock_symbols_from_file(market)
     elif force_download:
-        symbols = get_all_us_symbols(True) if market == 'us' else get_all_china_symbols(True)
+        symbols = await (get_all_us_symbols(True) if market == 'us'
+                         else get_all_china_symbols(True))
     else:
         symbols = get_symbols_from_db(market)
 
     batch_size = BATCH_SIZE if market == 'us' else BATCH_SIZE_CN
     engine = get_db_engine()
     total_symbols = len(symbols)
-    stats.total = total_symbols
-    
-    with tqdm(total=total_symbols, desc=f"Downloading {market.upper()} stocks") as pbar:
-        # First pass: Process all symbols in batches
-        for i in range(0, total_symbols, batch_size):
-            batch = symbols[i:i + batch_size]
+    # 本市场独立的统计对象，结束后汇入模块级stats
+    run_stats = DownloadStats()
+    run_stats.total = total_symbols
+
+    batches = [symbols[i:i + batch_size] for i in range(0, total_symbols, batch_size)]
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def bounded_process(batch):
+        """限流处理单个批次，异常随批次一起返回"""
+        async with sem:
             try:
-                success_count = await process_stocks_batch(batch, engine, market)
-                stats.add_success(success_count)
-                pbar.update(len(batch))
-                
+                return batch, await process_stocks_batch(batch, engine, market), None
             except Exception as e:
-                batch_symbols = [s['symbol'] for s in batch]
-                stats.add_failure(batch_symbols, str(e))
-                print(f"Batch failed: {str(e)}")
-        
-        
-        # Print final statistics
-        stats.print_summary()
+                return batch, 0, e
+
+    # 全量回填时先删非主键索引，结束后一次性重建：
+    # 百万行级写入不再为每行维护索引
+    if backfill:
+        drop_price_indexes(market)
+
+    try:
+        with tqdm(total=total_symbols, desc=f"Downloading {market.upper()} stocks") as pbar:
+            # 有界并发+按完成顺序处理：慢批次不会阻塞整轮进度
+            for future in asyncio.as_completed([bounded_process(batch) for batch in batches]):
+                batch, success_count, error = await future
+                if error is None:
+                    run_stats.add_success(success_count)
+                    pbar.update(len(batch))
+                else:
+                    batch_symbols = [s['symbol'] for s in batch]
+                    run_stats.add_failure(batch_symbols, str(error))
+                    print(f"Batch failed: {str(error)}")
+    finally:
+        stats.merge(run_stats)
+        if backfill:
+            recreate_price_indexes(market)
 
 async def main_async():
+    global stats
+    # 每次运行从零开始计数，task_manager读到的是本次结果
+    stats = DownloadStats()
+
+    # 默认executor也指向共享池，零散的run_in_executor(None, ...)不再各开线程
+    asyncio.get_running_loop().set_default_executor(_DOWNLOAD_POOL)
+
     # Initialize database
     initialize_database()
     print(f"Initialized database")
-    if china_stock:
-        china_task = asyncio.create_task(download_stocks_async('cn'))
-        #china_task = asyncio.create_task(download_china_stocks_async())
-        await asyncio.gather(china_task)
+    if all_markets:
+        # 两个市场并发跑；return_exceptions隔离错误，
+        # 一边失败不会把另一边取消在半途留下残批
+        results = await asyncio.gather(
+            download_stocks_async('us'),
+            download_stocks_async('cn'),
+            return_exceptions=True,
+        )
+        for market, result in zip(('us', 'cn'), results):
+            if isinstance(result, BaseException):
+                print(f"{market.upper()} download failed: {result}")
+    elif china_stock:
+        await download_stocks_async('cn')
+        #await download_china_stocks_async()
     else:
-        us_task = asyncio.create_task(download_stocks_async('us'))
-        await asyncio.gather(us_task)
+        await download_stocks_async('us')
+
+    # 所有市场跑完后打印一次汇总，避免并发跑时各打一份未定稿的统计
+    stats.print_summary()
 
 def main():
+    # uvloop装了就用（Windows不支持）；整条流水线都是IO密集的async
+    if uvloop is not None and sys.platform != 'win32':
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # Run the async main function
     asyncio.run(main_async())
 
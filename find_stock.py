@@ -1,13 +1,15 @@
 import akshare as ak
+import aiohttp
+import asyncio
 import pandas as pd
 import os
 import sys
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
-import time
 import random
 import json
 
+from utils.download_util import AsyncRateLimiter
+
 # 配置参数
 DATA_DIR = "./stock_data"
 CACHE_FILE = os.path.join(DATA_DIR, "cache_info.json")
@@ -57,58 +59,105 @@ def is_cache_valid():
 def get_all_a_shares():
     """获取全量A股代码列表"""
     file_path = f'{DATA_DIR}/a_stocks_list.csv'
-    
+    pkl_path = file_path + '.pkl'
+
+    # pickle旁路缓存（带mtime保护，同config.py模式）：重跑跳过CSV文本解析
+    if os.path.exists(pkl_path) and (
+            not os.path.exists(file_path)
+            or os.path.getmtime(pkl_path) >= os.path.getmtime(file_path)):
+        try:
+            stocks_df = pd.read_pickle(pkl_path)
+            print(f"Read {len(stocks_df)} stock symbols from cache")
+            return stocks_df[['code', 'name']]
+        except Exception as e:
+            print(f"读取股票清单缓存失败: {str(e)}")
+
     # Check if file exists and is not older than 1 day
-    if os.path.exists(file_path):        
-        stocks_df = pd.read_csv(file_path)
+    if os.path.exists(file_path):
+        # code按字符串读，保留'000001'这类前导零
+        stocks_df = pd.read_csv(file_path, dtype={'code': str})
         print(f"Read {len(stocks_df)} stock symbols from file")
-        return stocks_df[['code', 'name']]
     else:
-        all_stocks = ak.stock_info_a_code_name()[['code', 'name']]
+        stocks_df = ak.stock_info_a_code_name()[['code', 'name']]
         # Save to file
-        all_stocks.to_csv(file_path, index=False)
-        print(f"Saved {len(all_stocks)} stock symbols to file")
-        return all_stocks[['code', 'name']]
+        stocks_df.to_csv(file_path, index=False)
+        print(f"Saved {len(stocks_df)} stock symbols to file")
+
+    try:
+        stocks_df[['code', 'name']].to_pickle(pkl_path)
+    except Exception as e:
+        print(f"写入股票清单缓存失败: {str(e)}")
+    return stocks_df[['code', 'name']]
+
+# akshare的stock_zh_a_hist包装的就是东方财富K线接口，这里直接异步请求
+KLINE_URL = "http://push2his.eastmoney.com/api/qt/stock/kline/get"
+# 接口返回的逗号分隔字段顺序，与akshare的列名一一对应
+KLINE_COLUMNS = ['日期', '开盘', '收盘', '最高', '最低', '成交量',
+                 '成交额', '振幅', '涨跌幅', '涨跌额', '换手率']
+
+# 同时在途请求数：东财单IP限流较松，10路并发足够跑满下载
+DOWNLOAD_CONCURRENCY = 10
+
+# 令牌桶限速：只在逼近速率上限时等待，不给成功请求垫固定sleep
+DOWNLOAD_RATE_PER_SECOND = 5
+
+def _secid(stock_code):
+    """东财secid：沪市前缀1，深/北前缀0"""
+    code = str(stock_code).zfill(6)
+    return ('1.' if code.startswith('6') else '0.') + code
+
+async def download_with_retry(session, sem, limiter, stock_code, max_retries=3):
+    """带重试机制的异步下载函数"""
+    code = str(stock_code).zfill(6)
+    end_date = datetime.now().strftime("%Y%m%d")
+    start_date = (datetime.now() - timedelta(days=HISTORY_DAYS*2)).strftime("%Y%m%d")
+    params = {
+        'secid': _secid(code),
+        'fields1': 'f1,f2,f3,f4,f5,f6',
+        'fields2': 'f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61',
+        'klt': '101',   # 日线
+        'fqt': '1',     # 前复权
+        'beg': start_date,
+        'end': end_date,
+    }
 
-def download_with_retry(stock_code, max_retries=3):
-    """带重试机制的下载函数"""
     for attempt in range(max_retries):
         try:
-            # 添加随机延迟，避免请求过于频繁
-            time.sleep(random.uniform(1, 3))
-            
-            end_date = datetime.now().strftime("%Y%m%d")
-            start_date = (datetime.now() - timedelta(days=HISTORY_DAYS*2)).strftime("%Y%m%d")
-            
-            df = ak.stock_zh_a_hist(
-                symbol=stock_code, 
-                period="daily",
-                start_date=start_date,
-                end_date=end_date,
-                adjust="qfq"  # 前复权处理
+            async with sem, limiter:
+                async with session.get(KLINE_URL, params=params, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                    payload = await resp.json(content_type=None)
+
+            klines = (payload.get('data') or {}).get('klines') or []
+            df = pd.DataFrame(
+                [line.split(',') for line in klines], columns=KLINE_COLUMNS
             ).tail(HISTORY_DAYS)
-            
+
             if len(df) >= HISTORY_DAYS:
                 df.to_csv(f"{DATA_DIR}/{stock_code}.csv", index=False)
                 return True
             else:
                 print(f"下载{stock_code}数据不足{HISTORY_DAYS}天")
                 return False
-                
+
         except Exception as e:
-            if "Rate limited" in str(e):
-                # 遇到频率限制时等待更长时间
-                wait_time = random.uniform(5, 10)
-                print(f"遇到频率限制，等待{wait_time:.1f}秒...")
-                time.sleep(wait_time)
-            elif attempt < max_retries - 1:
+            if attempt < max_retries - 1:
                 print(f"下载{stock_code}失败 (尝试 {attempt + 1}/{max_retries}): {str(e)}")
-                time.sleep(random.uniform(2, 5))  # 失败后等待更长时间
+                await asyncio.sleep(random.uniform(2, 5))  # 失败后等待更长时间
             else:
                 print(f"下载{stock_code}最终失败: {str(e)}")
                 return False
     return False
 
+async def _download_all(codes):
+    """共享一个连接池并发下载所有代码"""
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=20, ttl_dns_cache=300)
+    sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    limiter = AsyncRateLimiter(DOWNLOAD_RATE_PER_SECOND)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(
+            *[download_with_retry(session, sem, limiter, code) for code in codes],
+            return_exceptions=True)
+
 def load_cached_data(stock_code):
     """加载本地缓存数据"""
     file_path = f"{DATA_DIR}/{stock_code}.csv"
@@ -121,10 +170,57 @@ def load_cached_data(stock_code):
             print(f"读取缓存文件{stock_code}失败: {str(e)}")
     return None
 
+# 合并后的单文件行情库：分析阶段一次读入，
+# 代替每次运行对几千个CSV逐个fopen+文本解析
+STORE_FILE = os.path.join(DATA_DIR, "stocks_daily.pkl")
+
+# 建库时顺带预计算的极值窗口：命中时分析只扫一张几千行的边表
+EXTREME_WINDOWS = (5, 10, 20, 60)
+EXTREMES_FILE = os.path.join(DATA_DIR, "extremes.pkl")
+
+def build_data_store():
+    """把逐股票CSV缓存合并成一个带code列的长表并pickle落盘"""
+    frames = []
+    for name in os.listdir(DATA_DIR):
+        if not name.endswith('.csv') or name == 'a_stocks_list.csv':
+            continue
+        code = name[:-4]
+        try:
+            df = pd.read_csv(os.path.join(DATA_DIR, name))
+        except Exception as e:
+            print(f"读取缓存文件{code}失败: {str(e)}")
+            continue
+        if len(df) >= HISTORY_DAYS:
+            frames.append(df.tail(HISTORY_DAYS).assign(code=code))
+    if frames:
+        big = pd.concat(frames, ignore_index=True, copy=False)
+        big.to_pickle(STORE_FILE)
+        print(f"合并行情库已更新：{big['code'].nunique()}只股票")
+
+        # 常用窗口的最高/最低预聚合到边表，查询时免去整库加载
+        extremes = {}
+        for window in EXTREME_WINDOWS:
+            tail = big.groupby('code', sort=False, group_keys=False).tail(window)
+            grouped = tail.groupby('code', sort=False)
+            extremes[f'最高_{window}'] = grouped['最高'].max()
+            extremes[f'最低_{window}'] = grouped['最低'].min()
+        pd.DataFrame(extremes).to_pickle(EXTREMES_FILE)
+
+def load_data_store():
+    """读取合并行情库，不存在或损坏时返回None（回退逐CSV路径）"""
+    if os.path.exists(STORE_FILE):
+        try:
+            return pd.read_pickle(STORE_FILE)
+        except Exception as e:
+            print(f"读取合并行情库失败: {str(e)}")
+    return None
+
 def batch_download_data():
     """批量下载全量股票数据"""
     if is_cache_valid():
         print("使用本周缓存的股票数据")
+        if not os.path.exists(STORE_FILE):
+            build_data_store()
         return
         
     stocks = get_all_a_shares()
@@ -132,40 +228,63 @@ def batch_download_data():
     #     # 更新缓存信息
     # update_cache_info()
 
-    # 减少并发数，避免请求过于频繁
-    with ThreadPoolExecutor(max_workers=2) as executor:  # 进一步减少并发数
-        futures = []
-        for _, row in stocks.iterrows():
-            code = row['code']
-            if not load_cached_data(code):
-                futures.append(executor.submit(download_with_retry, code))
-                # 每添加10个任务后暂停一下
-                if len(futures) % 10 == 0:
-                    time.sleep(random.uniform(2, 4))
-        
-        # 等待所有下载完成
-        for future in futures:
-            future.result()
-    
+    # 事件循环并发请求+keep-alive复用连接，
+    # 代替原来2线程池+逐任务sleep的串行下载
+    codes = [code for code in stocks['code'] if load_cached_data(code) is None]
+    if codes:
+        asyncio.run(_download_all(codes))
+
     # 更新缓存信息
     update_cache_info()
+    build_data_store()
+
+def _load_precomputed_extreme():
+    """读取预聚合边表中对应窗口的极值列，未命中返回None"""
+    if TARGET_DAYS not in EXTREME_WINDOWS or not os.path.exists(EXTREMES_FILE):
+        return None
+    try:
+        extremes = pd.read_pickle(EXTREMES_FILE)
+    except Exception as e:
+        print(f"读取极值边表失败: {str(e)}")
+        return None
+    col = f'{HIGH_OR_LOW}_{TARGET_DAYS}'
+    if col not in extremes.columns:
+        return None
+    return extremes[col].rename(HIGH_OR_LOW)
 
 def analyze_stocks(target_price):
-    """分析本地数据"""
-    matched = []
+    """分析本地数据
+
+    拼成一张长表后一次groupby聚合，代替逐股票的Python循环+max/min调用。
+    """
     stocks = get_all_a_shares()
-    
-    for _, row in stocks.iterrows():
-        code, name = row['code'], row['name']
-        df = load_cached_data(code)
-        if df is not None:
-            # 只分析最近TARGET_DAYS天的数据
-            recent_data = df.tail(TARGET_DAYS)
-            max_high = recent_data[HIGH_OR_LOW].max() if HIGH_OR_LOW == '最高' else recent_data[HIGH_OR_LOW].min()
-            if abs(max_high - target_price) < 0.001:  # 浮点精度处理
-                matched.append({'代码': code, '名称': name, HIGH_OR_LOW: round(max_high,2)})
-    
-    return pd.DataFrame(matched)
+
+    # 最快路径：窗口命中预聚合边表时，分析只剩一次小表过滤
+    extreme = _load_precomputed_extreme()
+    if extreme is None:
+        # 优先走合并行情库：单文件一次读入
+        store = load_data_store()
+        if store is not None:
+            big = store.groupby('code', sort=False, group_keys=False).tail(TARGET_DAYS)
+        else:
+            # 回退路径：逐CSV读入后再拼接
+            frames = []
+            for code in stocks['code']:
+                df = load_cached_data(code)
+                if df is not None:
+                    frames.append(df.tail(TARGET_DAYS)[[HIGH_OR_LOW]].assign(code=code))
+            if not frames:
+                return pd.DataFrame()
+            big = pd.concat(frames, copy=False)
+        agg = 'max' if HIGH_OR_LOW == '最高' else 'min'
+        extreme = big.groupby('code', sort=False)[HIGH_OR_LOW].agg(agg)
+    hits = extreme[(extreme - target_price).abs() < 0.001].round(2)  # 浮点精度处理
+    if hits.empty:
+        return pd.DataFrame()
+
+    result = stocks.merge(hits, left_on='code', right_index=True)
+    result.rename(columns={'code': '代码', 'name': '名称'}, inplace=True)
+    return result[['代码', '名称', HIGH_OR_LOW]]
 
 if __name__ == "__main__":
     init_data_dir()
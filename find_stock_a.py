@@ -6,6 +6,8 @@ import sys
 from datetime import datetime, timedelta
 import time
 import random
+import requests
+from requests.adapters import HTTPAdapter
 import json
 
 # 配置参数
@@ -22,6 +24,15 @@ TUSHARE_TOKEN = "26977fd4744f7f489cd2c9803ce98c8f55dd1dba0dd0c70466877bcc"  # 
 ts.set_token(TUSHARE_TOKEN)
 pro = ts.pro_api()
 
+# 共享keep-alive连接池：tushare/akshare底层走requests的模块级接口，
+# 重定向到同一个Session，几千次调用复用连接而不是每次握手
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+_SESSION.mount('https://', _adapter)
+_SESSION.mount('http://', _adapter)
+requests.get = _SESSION.get
+requests.post = _SESSION.post
+
 def init_data_dir():
     """初始化数据存储目录"""
     os.makedirs(DATA_DIR, exist_ok=True)
@@ -84,19 +95,35 @@ def is_cache_valid():
 def get_all_a_shares():
     """获取全量A股代码列表"""
     file_path = f'a_stocks_list.csv'
-    
+    pkl_path = file_path + '.pkl'
+
+    # pickle旁路缓存（带mtime保护，同config.py模式）：重跑跳过CSV文本解析
+    if os.path.exists(pkl_path) and (
+            not os.path.exists(file_path)
+            or os.path.getmtime(pkl_path) >= os.path.getmtime(file_path)):
+        try:
+            stocks_df = pd.read_pickle(pkl_path)
+            print(f"Read {len(stocks_df)} stock symbols from cache")
+            return stocks_df[['ts_code', 'name']]
+        except Exception as e:
+            print(f"Error reading stock list cache: {str(e)}")
+
     # Check if file exists and is not older than 1 day
-    if os.path.exists(file_path):        
+    if os.path.exists(file_path):
         stocks_df = pd.read_csv(file_path)
         print(f"Read {len(stocks_df)} stock symbols from file")
-        return stocks_df[['ts_code', 'name']]
     else:
-        all_stocks = ak.stock_info_a_code_name()[['code', 'name']]
-        all_stocks.rename(columns={'code': 'ts_code'}, inplace=True)
+        stocks_df = ak.stock_info_a_code_name()[['code', 'name']]
+        stocks_df.rename(columns={'code': 'ts_code'}, inplace=True)
         # Save to file
-        all_stocks.to_csv(file_path, index=False)
-        print(f"Saved {len(all_stocks)} stock symbols to file")
-        return all_stocks[['ts_code', 'name']]
+        stocks_df.to_csv(file_path, index=False)
+        print(f"Saved {len(stocks_df)} stock symbols to file")
+
+    try:
+        stocks_df[['ts_code', 'name']].to_pickle(pkl_path)
+    except Exception as e:
+        print(f"Error writing stock list cache: {str(e)}")
+    return stocks_df[['ts_code', 'name']]
 
 def load_cached_data(stock_code):
     """加载本地缓存数据"""
@@ -192,28 +219,31 @@ def batch_download_data():
     update_cache_info()
 
 def analyze_stocks(target_price):
-    """分析股票数据"""
-    matched = []
+    """分析股票数据
+
+    拼成一张长表后一次groupby聚合，代替逐股票的Python循环+max/min调用。
+    """
     stocks = get_all_a_shares()
-    
-    for _, row in stocks.iterrows():
-        code, name = row['ts_code'], row['name']
+
+    frames = []
+    for code in stocks['ts_code']:
         df = load_cached_data(code)
         if df is not None:
-            recent_data = df.tail(TARGET_DAYS)
-            if HIGH_OR_LOW == 'high':
-                extreme = recent_data['high'].max()
-            else:
-                extreme = recent_data['low'].min()
-            
-            if abs(extreme - target_price) < 0.001:  # 1% tolerance
-                matched.append({
-                    '代码': str(code).zfill(6),
-                    '名称': name,
-                    HIGH_OR_LOW: round(extreme, 2)
-                })
-    
-    return pd.DataFrame(matched)
+            frames.append(df.tail(TARGET_DAYS)[[HIGH_OR_LOW]].assign(ts_code=code))
+    if not frames:
+        return pd.DataFrame()
+
+    big = pd.concat(frames, copy=False)
+    agg = 'max' if HIGH_OR_LOW == 'high' else 'min'
+    extreme = big.groupby('ts_code', sort=False)[HIGH_OR_LOW].agg(agg)
+    hits = extreme[(extreme - target_price).abs() < 0.001].round(2)  # 1% tolerance
+    if hits.empty:
+        return pd.DataFrame()
+
+    result = stocks.merge(hits, left_on='ts_code', right_index=True)
+    result['ts_code'] = result['ts_code'].astype(str).str.zfill(6)
+    result.rename(columns={'ts_code': '代码', 'name': '名称'}, inplace=True)
+    return result[['代码', '名称', HIGH_OR_LOW]]
 
 if __name__ == "__main__":
     if not TUSHARE_TOKEN or TUSHARE_TOKEN == "your_token_here":
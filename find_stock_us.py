@@ -3,7 +3,6 @@ import pandas as pd
 import os
 import datetime
 import argparse
-import time
 import random
 from tqdm import tqdm
 import pickle
@@ -170,21 +169,39 @@ def update_stock_data_cache(stocks):
 
     if stocks_to_download:
         print(f"Downloading data for {len(stocks_to_download)} stocks...")
+        # Batched multi-ticker download: one request round per chunk with
+        # yfinance's internal thread pool, instead of serial per-ticker
+        # history() calls separated by 1s sleeps
+        chunk_size = 200
         with tqdm(total=len(stocks_to_download)) as progress:
-            for ticker in stocks_to_download:
+            for i in range(0, len(stocks_to_download), chunk_size):
+                chunk = stocks_to_download[i:i + chunk_size]
                 try:
-                    stock = yf.Ticker(ticker)
-                    hist = stock.history(start=start_date, end=end_date)
-                    
-                    if not hist.empty and len(hist) >= 2:
-                        new_cache[ticker] = hist
-                    
-                    # Add a small delay to avoid hitting API rate limits
-                    time.sleep(1)
+                    # 不传session：yfinance 0.2.x强制使用自带的curl_cffi
+                    # 会话（自身已做连接池化），外部Session会被直接拒绝
+                    data = yf.download(
+                        chunk,
+                        start=start_date,
+                        end=end_date,
+                        group_by='ticker',
+                        threads=True,
+                        progress=False
+                    )
+                    if data is not None and not data.empty:
+                        if len(chunk) == 1:
+                            # Single ticker comes back with flat columns
+                            frames = {chunk[0]: data}
+                        else:
+                            present = set(data.columns.get_level_values(0))
+                            frames = {t: data[t] for t in chunk if t in present}
+                        for ticker, hist in frames.items():
+                            hist = hist.dropna(how='all')
+                            if not hist.empty and len(hist) >= 2:
+                                new_cache[ticker] = hist
                 except Exception as e:
-                    progress.write(f"Error downloading {ticker}: {str(e)}")
-                
-                progress.update(1)
+                    progress.write(f"Error downloading chunk {chunk[0]}..{chunk[-1]}: {str(e)}")
+
+                progress.update(len(chunk))
 
     
     save_stock_data_cache(new_cache)
@@ -1,3 +1,4 @@
+import io
 import os
 from datetime import datetime, timedelta
 import pandas as pd
@@ -9,9 +10,18 @@ from dotenv import load_dotenv
 from config import config
 from strategies import AVAILABLE_STRATEGIES, Strategy, DAYS_MAP
 
+_db_engine = None
+
 def get_db_engine():
-    """创建PostgreSQL数据库连接"""
-    return create_engine(config.db_url)
+    """创建PostgreSQL数据库连接（进程内只建一个引擎/连接池）"""
+    global _db_engine
+    if _db_engine is None:
+        _db_engine = create_engine(
+            config.db_url,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+        )
+    return _db_engine
 
 def get_available_symbols(market: str, limit: int = None, offset: int = 0) -> List[str]:
     """获取可用的股票代码列表"""
@@ -47,35 +57,58 @@ class StockAnalyzer:
         self.strategies.append(strategy)
 
     def get_stock_data(self, days: int = 10, symbols: List[str] = None) -> pd.DataFrame:
-        """获取指定天数的股票数据"""
+        """获取指定天数的股票数据
+
+        优先使用PostgreSQL COPY批量导出，绕过逐行协议开销，
+        大日期范围下比read_sql_query快数倍且内存更低。
+        """
         table_name = f"{self.market}_stock_prices"
         end_date = datetime.now().date()
         start_date = end_date - timedelta(days=days)
 
+        where_clause = f"date >= '{start_date}'"
+        if symbols:
+            # 使用IN子句限制股票代码
+            quoted = ','.join("'" + s.replace("'", "''") + "'" for s in symbols)
+            where_clause += f" AND symbol IN ({quoted})"
+
+        # 不在SQL里ORDER BY：排序在客户端用pandas完成，省掉数据库的sort节点
         query = f"""
         SELECT *
         FROM {table_name}
-        WHERE date >= :start_date
+        WHERE {where_clause}
         """
-        
-        params = {'start_date': start_date}
-        
-        if symbols:
-            # 使用IN子句限制股票代码
-            placeholders = ','.join([f':symbol_{i}' for i in range(len(symbols))])
-            query += f" AND symbol IN ({placeholders})"
-            for i, symbol in enumerate(symbols):
-                params[f'symbol_{i}'] = symbol
-        
-        query += " ORDER BY symbol, date"
 
         try:
-            with self.engine.connect() as conn:
-                df = pd.read_sql_query(
-                    text(query),
-                    conn,
-                    params=params
-                )
+            raw_conn = self.engine.raw_connection()
+            try:
+                cursor = raw_conn.cursor()
+                buf = io.BytesIO()
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", buf)
+                buf.seek(0)
+                df = pd.read_csv(buf, parse_dates=['date'])
+            finally:
+                raw_conn.close()
+            df.sort_values(['symbol', 'date'], inplace=True, ignore_index=True)
+            return df
+        except Exception as e:
+            print(f"Error getting stock data via COPY, falling back to read_sql: {str(e)}")
+
+        # 回退路径：服务端游标分块流式读取，峰值内存只有一个分块
+        try:
+            with self.engine.connect().execution_options(
+                stream_results=True, yield_per=10000
+            ) as conn:
+                result = conn.execute(text(query))
+                columns = list(result.keys())
+                chunks = [
+                    pd.DataFrame(partition, columns=columns)
+                    for partition in result.partitions()
+                ]
+            if not chunks:
+                return pd.DataFrame(columns=columns)
+            df = pd.concat(chunks, ignore_index=True, copy=False)
+            df.sort_values(['symbol', 'date'], inplace=True, ignore_index=True)
             return df
         except Exception as e:
             print(f"Error getting stock data: {str(e)}")
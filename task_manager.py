@@ -58,17 +58,24 @@ class TaskManager:
             conn.commit()
             return result.scalar()
 
+    # 动态UPDATE语句缓存，按参数名组合复用text()对象
+    _update_stmt_cache: Dict[tuple, Any] = {}
+
     def _update_task(self, task_id: int, **kwargs):
         """更新任务状态"""
-        set_clause = ", ".join(f"{k} = :{k}" for k in kwargs.keys())
-        query = f"""
-            UPDATE task_status
-            SET {set_clause}, last_update_time = :last_update_time
-            WHERE id = :task_id
-        """
+        cache_key = tuple(sorted(kwargs.keys()))
+        query = self._update_stmt_cache.get(cache_key)
+        if query is None:
+            set_clause = ", ".join(f"{k} = :{k}" for k in cache_key)
+            query = text(f"""
+                UPDATE task_status
+                SET {set_clause}, last_update_time = :last_update_time
+                WHERE id = :task_id
+            """)
+            self._update_stmt_cache[cache_key] = query
         with self.engine.connect() as conn:
             conn.execute(
-                text(query),
+                query,
                 {
                     'task_id': task_id,
                     'last_update_time': datetime.now(),
@@ -77,18 +84,43 @@ class TaskManager:
             )
             conn.commit()
 
+    def _is_task_running(self, task_type: str, market: str) -> bool:
+        """检查是否有未超时的运行中任务（EXISTS在首个匹配行即短路）"""
+        query = """
+            SELECT EXISTS(
+                SELECT 1
+                FROM task_status
+                WHERE task_type = :task_type
+                AND market = :market
+                AND status = 'running'
+                AND last_update_time > :cutoff
+            )
+        """
+        with self.engine.connect() as conn:
+            result = conn.execute(
+                text(query),
+                {
+                    'task_type': task_type,
+                    'market': market,
+                    'cutoff': datetime.now() - timedelta(hours=4)
+                }
+            )
+            return bool(result.scalar())
+
     def _is_task_needed(self, task_type: str, market: str) -> bool:
         """检查是否需要运行新任务"""
+        # 常见的轮询路径：有未超时的运行中任务时直接跳过，不取整行
+        if self._is_task_running(task_type, market):
+            print("Latest task is running, skipping")
+            return False
+
         latest_task = self._get_latest_task(task_type, market)
         if not latest_task:
             return True
 
-        # 如果有正在运行的任务，检查是否超时
+        # 运行中但已超时（上面的EXISTS未命中）的任务视为失效，需要重跑
         if latest_task['status'] == 'running':
-            if datetime.now() - latest_task['last_update_time'] > timedelta(hours=4):
-                return True
-            print(f"Latest task is running, skipping: {latest_task['last_update_time']}")
-            return False
+            return True
 
         # 如果最后一次更新是在12小时之内，不需要运行
         if datetime.now() - latest_task['last_update_time'] < timedelta(hours=12):
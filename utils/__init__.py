@@ -1,5 +1,5 @@
 """工具包"""
 
-from .download_util import DownloadStats
+from .download_util import AsyncRateLimiter, CircuitBreaker, DownloadStats
 
-__all__ = ['DownloadStats']
+__all__ = ['AsyncRateLimiter', 'CircuitBreaker', 'DownloadStats']
@@ -1,5 +1,95 @@
 """下载工具类"""
 
+import asyncio
+import time
+import weakref
+
+class AsyncRateLimiter:
+    """令牌桶限速器
+
+    令牌按速率平滑补充，请求只等到下一个令牌可用为止，
+    不像固定sleep那样按整秒对齐节流。用法：async with limiter: ...
+
+    可跨事件循环复用：asyncio.Lock会绑定首个使用它的loop，
+    这里按loop各建一把锁，令牌余额本身跨loop共享。
+    """
+    def __init__(self, rate, period=1.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._last = time.monotonic()
+        self._locks = weakref.WeakKeyDictionary()
+
+    def _loop_lock(self):
+        """获取当前事件循环对应的锁"""
+        loop = asyncio.get_running_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[loop] = lock
+        return lock
+
+    async def acquire(self):
+        """等待并消耗一个令牌"""
+        async with self._loop_lock():
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    float(self.rate),
+                    self._tokens + (now - self._last) * self.rate / self.period
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+class CircuitBreaker:
+    """熔断器（CLOSED→OPEN→HALF_OPEN）
+
+    连续失败达到阈值后打开，之后的请求直接快速失败，
+    不再消耗重试退避时间；冷却期过后放行一个探测请求，
+    成功则恢复，失败则重新计时。
+    """
+    def __init__(self, failure_threshold=20, recovery_timeout=60, name=''):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.name = name
+        self._failures = 0
+        self._opened_at = None
+
+    def allow(self):
+        """当前是否放行请求（冷却期满时放行探测）"""
+        if self._opened_at is None:
+            return True
+        return time.monotonic() - self._opened_at >= self.recovery_timeout
+
+    def record_success(self):
+        """记录一次成功，恢复到CLOSED状态"""
+        if self._opened_at is not None:
+            print(f"Circuit breaker {self.name} recovered, resuming requests")
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        """记录一次失败，必要时打开熔断"""
+        self._failures += 1
+        if self._opened_at is not None:
+            # 探测失败：重新计时冷却期
+            self._opened_at = time.monotonic()
+        elif self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            print(f"Circuit breaker {self.name} opened after "
+                  f"{self._failures} consecutive failures, "
+                  f"fast-failing for {self.recovery_timeout}s")
+
 class DownloadStats:
     """下载统计"""
     def __init__(self):
@@ -16,11 +106,17 @@ class DownloadStats:
         """添加失败记录"""
         if isinstance(symbols, str):
             symbols = [symbols]
-        for symbol in symbols:
-            self.failed.add(symbol)
-            if reason not in self.failed_reasons:
-                self.failed_reasons[reason] = set()
-            self.failed_reasons[reason].add(symbol)
+        # C层set.update代替逐元素Python循环
+        self.failed.update(symbols)
+        self.failed_reasons.setdefault(reason, set()).update(symbols)
+
+    def merge(self, other):
+        """并入另一份统计（各市场独立计数后汇总）"""
+        self.total += other.total
+        self.success += other.success
+        self.failed.update(other.failed)
+        for reason, symbols in other.failed_reasons.items():
+            self.failed_reasons.setdefault(reason, set()).update(symbols)
     
     def print_summary(self):
         """打印统计摘要"""
@@ -0,0 +1,66 @@
+"""移动平均计算核心
+
+numba可用时JIT编译为单遍扫描核心：一次遍历Close数组同时维护
+所有窗口的滑动和，填充全部MA列；不可用时由调用方退回逐窗口计算。
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """numba缺失时的空装饰器，保持模块可导入"""
+        def wrap(func):
+            return func
+        if args and callable(args[0]):
+            return args[0]
+        return wrap
+
+
+@njit(nogil=True, cache=True)
+def _rolling_means_kernel(close, windows, min_counts, out):
+    n = close.shape[0]
+    k = windows.shape[0]
+    sums = np.zeros(k)
+    counts = np.zeros(k, dtype=np.int64)
+    for i in range(n):
+        value = close[i]
+        value_ok = not np.isnan(value)
+        for j in range(k):
+            if value_ok:
+                sums[j] += value
+                counts[j] += 1
+            if i >= windows[j]:
+                old = close[i - windows[j]]
+                if not np.isnan(old):
+                    sums[j] -= old
+                    counts[j] -= 1
+            if counts[j] >= min_counts[j]:
+                out[i, j] = sums[j] / counts[j]
+            else:
+                out[i, j] = np.nan
+
+
+def rolling_means(close, windows, min_counts):
+    """一次遍历计算多窗口滑动均值，返回(n, len(windows))的float64矩阵"""
+    for window, min_count in zip(windows, min_counts):
+        if min_count > window:
+            raise ValueError(f"min_count {min_count} must not exceed window {window}")
+
+    out = np.empty((close.shape[0], len(windows)), dtype=np.float64)
+    _rolling_means_kernel(
+        np.ascontiguousarray(close, dtype=np.float64),
+        np.asarray(windows, dtype=np.int64),
+        np.asarray(min_counts, dtype=np.int64),
+        out,
+    )
+    return out
+
+
+if HAS_NUMBA:
+    # 导入时用小数组预热一次，把JIT编译成本移出热路径（cache=True时只发生一次）
+    rolling_means(np.zeros(8), [5], [5])